@@ -40,7 +40,6 @@ import struct
 import tempfile
 import M2Crypto
 import base64
-import hashlib
 import errno
 import re
 
@@ -856,14 +855,9 @@ class Guest(object):
         self.log.debug("Calculating checksum of downloaded file")
         os.lseek(outputfd, 0, os.SEEK_SET)
 
-        local_sum = getattr(hashlib, hashname)()
+        local_sum = oz.ozutil.hash_fd(outputfd, hashname)
 
-        buf = oz.ozutil.read_bytes_from_fd(outputfd, 4096)
-        while buf != '':
-            local_sum.update(buf)
-            buf = oz.ozutil.read_bytes_from_fd(outputfd, 4096)
-
-        return local_sum.hexdigest() == upstream_sum
+        return local_sum == upstream_sum.lower()
 
     def _get_original_media(self, url, output, force_download):
         """
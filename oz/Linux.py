@@ -22,10 +22,43 @@ import re
 import time
 import libvirt
 import os
+import subprocess
+import pipes
+import stat
+import tempfile
+import shutil
 
 import oz.Guest
 import oz.OzException
 
+# ServerAliveInterval protects against NAT firewall timeouts
+# on long-running commands with no output
+#
+# PasswordAuthentication=no prevents us from falling back to
+# keyboard-interactive password prompting
+#
+# -F /dev/null makes sure that we don't use the global or per-user
+# configuration files
+_SSH_OPTS = ("-F", "/dev/null",
+             "-o", "ServerAliveInterval=30",
+             "-o", "StrictHostKeyChecking=no",
+             "-o", "UserKnownHostsFile=/dev/null",
+             "-o", "PasswordAuthentication=no")
+
+_connect_timeout_cache = {}
+
+def _connect_timeout_opts(timeout):
+    """
+    Internal function to get the ssh options for a connection timeout.  Only a
+    handful of distinct timeouts are ever used, so the results are cached.
+    """
+    try:
+        return _connect_timeout_cache[timeout]
+    except KeyError:
+        opts = ("-o", "ConnectTimeout=" + str(timeout))
+        _connect_timeout_cache[timeout] = opts
+        return opts
+
 class LinuxCDGuest(oz.Guest.CDGuest):
     """
     Class for Linux installation.
@@ -36,6 +69,23 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                                   nicmodel, None, None, diskbus, iso_allowed,
                                   url_allowed, macaddress)
 
+        # private directory holding the ssh master connection socket while
+        # a customization is running; see _ssh_mux_opts()
+        self._ssh_mux_dir = None
+
+    def _ssh_mux_opts(self):
+        """
+        Internal method to get the ssh options that let ssh reuse the
+        connection of a master started by _open_ssh_mux(), instead of doing a
+        full handshake each time.  The socket lives in a directory only we can
+        write to, since anyone able to create it could otherwise take over
+        our connections.
+        """
+        if self._ssh_mux_dir is None:
+            return []
+        return ["-o", "ControlPath=" + os.path.join(self._ssh_mux_dir,
+                                                    "%r@%h:%p")]
+
     def _test_ssh_connection(self, guestaddr):
         """
         Internal method to test out the ssh connection before we try to use it.
@@ -65,6 +115,51 @@ class LinuxCDGuest(oz.Guest.CDGuest):
             self.log.debug("Failed to connect to ssh on running guest")
             raise oz.OzException.OzException("Failed to connect to ssh on running guest")
 
+    def _open_ssh_mux(self, guestaddr, timeout=10):
+        """
+        Internal method to start a persistent ssh master connection to the
+        guest, so that subsequent ssh and scp invocations can multiplex over it
+        instead of each doing their own handshake.  Failing to start the
+        master is not fatal; the commands just connect on their own.
+        """
+        # the master is started separately (rather than with
+        # ControlMaster=auto on the first command) because the backgrounded
+        # master keeps the stdout and stderr of the process that started it
+        # open, which would make subprocess_check_output() wait for it to exit
+        devnull = open(os.devnull, 'w')
+        try:
+            retcode = subprocess.call(["ssh", "-i", self.sshprivkey] +
+                                      list(_SSH_OPTS) + self._ssh_mux_opts() +
+                                      list(_connect_timeout_opts(timeout)) +
+                                      ["-o", "ControlMaster=yes",
+                                       "-o", "ControlPersist=60s",
+                                       "-f", "-N", "root@" + guestaddr],
+                                      stdin=devnull, stdout=devnull,
+                                      stderr=devnull)
+        finally:
+            devnull.close()
+
+        if retcode != 0:
+            self.log.debug("Failed to start ssh master connection, continuing without it")
+
+    def close_ssh_mux(self, guestaddr):
+        """
+        Method to tear down the ssh master connection to the guest, if any.
+        """
+        if self._ssh_mux_dir is None:
+            return
+
+        try:
+            oz.ozutil.subprocess_check_output(["ssh"] + list(_SSH_OPTS) +
+                                              self._ssh_mux_opts() +
+                                              ["-O", "exit",
+                                               "root@" + guestaddr],
+                                              printfn=self.log.debug)
+        except oz.ozutil.SubprocessException:
+            # there was no master running (or it already went away with
+            # the guest), so there is nothing to do
+            pass
+
     def get_default_runlevel(self, g_handle):
         """
         Function to determine the default runlevel based on the /etc/inittab.
@@ -83,23 +178,11 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         """
         Method to execute a command on the guest and return the output.
         """
-        # ServerAliveInterval protects against NAT firewall timeouts
-        # on long-running commands with no output
-        #
-        # PasswordAuthentication=no prevents us from falling back to
-        # keyboard-interactive password prompting
-        #
-        # -F /dev/null makes sure that we don't use the global or per-user
-        # configuration files
-
-        return oz.ozutil.subprocess_check_output(["ssh", "-i", self.sshprivkey,
-                                                  "-F", "/dev/null",
-                                                  "-o", "ServerAliveInterval=30",
-                                                  "-o", "StrictHostKeyChecking=no",
-                                                  "-o", "ConnectTimeout=" + str(timeout),
-                                                  "-o", "UserKnownHostsFile=/dev/null",
-                                                  "-o", "PasswordAuthentication=no",
-                                                  "root@" + guestaddr, command],
+        return oz.ozutil.subprocess_check_output(["ssh", "-i", self.sshprivkey] +
+                                                 list(_SSH_OPTS) +
+                                                 self._ssh_mux_opts() +
+                                                 list(_connect_timeout_opts(timeout)) +
+                                                 ["root@" + guestaddr, command],
                                                  printfn=self.log.debug)
 
     def guest_live_upload(self, guestaddr, file_to_upload, destination,
@@ -107,28 +190,26 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         """
         Method to copy a file to the live guest.
         """
-        self.guest_execute_command(guestaddr,
-                                   "mkdir -p " + os.path.dirname(destination),
-                                   timeout)
-
-        # ServerAliveInterval protects against NAT firewall timeouts
-        # on long-running commands with no output
-        #
-        # PasswordAuthentication=no prevents us from falling back to
-        # keyboard-interactive password prompting
-        #
-        # -F /dev/null makes sure that we don't use the global or per-user
-        # configuration files
-        return oz.ozutil.subprocess_check_output(["scp", "-i", self.sshprivkey,
-                                                  "-F", "/dev/null",
-                                                  "-o", "ServerAliveInterval=30",
-                                                  "-o", "StrictHostKeyChecking=no",
-                                                  "-o", "ConnectTimeout=" + str(timeout),
-                                                  "-o", "UserKnownHostsFile=/dev/null",
-                                                  "-o", "PasswordAuthentication=no",
-                                                  file_to_upload,
-                                                  "root@" + guestaddr + ":" + destination],
-                                                 printfn=self.log.debug)
+        # creating the destination directory and writing the file are done
+        # in a single ssh invocation, so that the upload only costs one round
+        # trip.  The chmod gives the file the same permissions that scp would
+        # have given it
+        mode = stat.S_IMODE(os.stat(file_to_upload).st_mode)
+        dest = pipes.quote(destination)
+        command = "mkdir -p %s && cat > %s && chmod %o %s" % (pipes.quote(os.path.dirname(destination)),
+                                                             dest, mode, dest)
+
+        infile = open(file_to_upload, 'rb')
+        try:
+            return oz.ozutil.subprocess_check_output(["ssh", "-i", self.sshprivkey] +
+                                                     list(_SSH_OPTS) +
+                                                     self._ssh_mux_opts() +
+                                                     list(_connect_timeout_opts(timeout)) +
+                                                     ["root@" + guestaddr, command],
+                                                     stdin=infile,
+                                                     printfn=self.log.debug)
+        finally:
+            infile.close()
 
     def _customize_files(self, guestaddr):
         """
@@ -137,7 +218,7 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         self.log.info("Uploading custom files")
         for name, fp in list(self.tdl.files.items()):
             # all of the self.tdl.files are named temporary files; we just need
-            # to fetch the name out and have scp upload it
+            # to fetch the name out and upload it
             self.guest_live_upload(guestaddr, fp.name, name)
 
     def _shutdown_guest(self, guestaddr, libvirt_dom):
@@ -307,6 +388,8 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                 guestaddr = None
                 guestaddr = self._wait_for_guest_boot(libvirt_dom)
                 self._test_ssh_connection(guestaddr)
+                self._ssh_mux_dir = tempfile.mkdtemp(prefix="oz-ssh-")
+                self._open_ssh_mux(guestaddr)
 
                 if action == "gen_and_mod":
                     self.do_customize(guestaddr)
@@ -318,13 +401,22 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                 else:
                     raise oz.OzException.OzException("Invalid customize action %s; this is a programming error" % (action))
             finally:
-                if action == "gen_only" and self.safe_icicle_gen:
-                    # if this is a gen_only and safe_icicle_gen, there is no
-                    # reason to wait around for the guest to shutdown; we'll
-                    # be removing the overlay file anyway.  Just destroy it
-                    libvirt_dom.destroy()
-                else:
-                    self._shutdown_guest(guestaddr, libvirt_dom)
+                try:
+                    if action == "gen_only" and self.safe_icicle_gen:
+                        # if this is a gen_only and safe_icicle_gen, there is
+                        # no reason to wait around for the guest to shutdown;
+                        # we'll be removing the overlay file anyway.  Just
+                        # destroy it
+                        libvirt_dom.destroy()
+                    else:
+                        self._shutdown_guest(guestaddr, libvirt_dom)
+                finally:
+                    if self._ssh_mux_dir is not None:
+                        try:
+                            self.close_ssh_mux(guestaddr)
+                        finally:
+                            shutil.rmtree(self._ssh_mux_dir, ignore_errors=True)
+                            self._ssh_mux_dir = None
         finally:
             if action == "gen_only" and self.safe_icicle_gen:
                 # no need to teardown because we simply discard the file
@@ -20,7 +20,6 @@ Miscellaneous utility functions.
 """
 
 import os
-import random
 import subprocess
 import tempfile
 import errno
@@ -28,7 +27,6 @@ import stat
 import shutil
 import pycurl
 import gzip
-import time
 import select
 try:
     import configparser
@@ -37,18 +35,53 @@ except ImportError:
 import collections
 import ftplib
 import struct
+import re
+import hashlib
+import io
+import ctypes
+import ctypes.util
+
+# os.SEEK_DATA and os.SEEK_HOLE only exist in python 3.3 and later; the values
+# below are the ones used by Linux
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# all of the automated installation paths are installed to $pkg_path/auto.
+# This is resolved once at import time, so that later changes of the current
+# working directory do not matter and no getcwd() is needed per call
+_AUTO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "auto"))
 
 def generate_full_auto_path(relative):
     """
     Function to find the absolute path to an unattended installation file.
     """
-    # all of the automated installation paths are installed to $pkg_path/auto,
-    # so we just need to find it and generate the right path here
     if relative is None:
         raise Exception("The relative path cannot be None")
 
-    pkg_path = os.path.dirname(__file__)
-    return os.path.abspath(os.path.join(pkg_path, "auto", relative))
+    return os.path.normpath(os.path.join(_AUTO_DIR, relative))
+
+def _split_path():
+    """
+    Internal function to split the PATH of the user into its component
+    directories, with any duplicate entries removed.
+    """
+    paths = os.environ.get("PATH", os.defpath).split(os.pathsep)
+    return list(collections.OrderedDict.fromkeys(paths))
+
+# the PATH and the executables on it do not change during an oz run, so the
+# results of executable_exists() are cached here.  A value of None means that
+# the executable could not be found
+_exe_path = _split_path()
+_exe_cache = {}
+
+def invalidate_exe_cache():
+    """
+    Function to throw away the cached results of executable_exists(), and to
+    re-read the PATH of the user.
+    """
+    global _exe_path
+    _exe_path = _split_path()
+    _exe_cache.clear()
 
 def executable_exists(program):
     """
@@ -65,17 +98,26 @@ def executable_exists(program):
     if program is None:
         raise Exception("Invalid program name passed")
 
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
+    try:
+        result = _exe_cache[program]
+    except KeyError:
+        result = None
+        fpath, fname = os.path.split(program)
+        if fpath:
+            if is_exe(program):
+                result = program
+        else:
+            for path in _exe_path:
+                exe_file = os.path.join(path, program)
+                if is_exe(exe_file):
+                    result = exe_file
+                    break
+        _exe_cache[program] = result
+
+    if result is None:
+        raise Exception("Could not find %s" % (program))
 
-    raise Exception("Could not find %s" % (program))
+    return result
 
 def write_bytes_to_fd(fd, buf):
     """
@@ -120,10 +162,226 @@ def read_bytes_from_fd(fd, num):
 
     return ret
 
+def _load_libc():
+    """
+    Internal function to load the C library, so that functions that python
+    2 does not wrap can be called directly.  Returns None if it cannot be
+    loaded.
+    """
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+def _libc_function(name, argtypes, restype):
+    """
+    Internal function to look up name in the C library and set up its
+    prototype.  Returns None if it is not available.
+    """
+    if _libc is None:
+        return None
+
+    try:
+        func = getattr(_libc, name)
+    except AttributeError:
+        return None
+
+    func.argtypes = argtypes
+    func.restype = restype
+    return func
+
+_libc = _load_libc()
+
+# os.posix_fadvise() only exists in python 3.3 and later, so we call the C
+# library directly.  The advice values below are the ones used by Linux,
+# where 64-bit s390 is the one architecture with a different DONTNEED
+_posix_fadvise = _libc_function('posix_fadvise64',
+                                [ctypes.c_int, ctypes.c_int64,
+                                 ctypes.c_int64, ctypes.c_int],
+                                ctypes.c_int)
+POSIX_FADV_SEQUENTIAL = 2
+if os.uname()[4] == 's390x':
+    POSIX_FADV_DONTNEED = 6
+else:
+    POSIX_FADV_DONTNEED = 4
+
+# likewise, os.copy_file_range() and os.sendfile() only exist in python 3
+_copy_file_range = _libc_function('copy_file_range',
+                                  [ctypes.c_int,
+                                   ctypes.POINTER(ctypes.c_int64),
+                                   ctypes.c_int,
+                                   ctypes.POINTER(ctypes.c_int64),
+                                   ctypes.c_size_t, ctypes.c_uint],
+                                  ctypes.c_ssize_t)
+_sendfile = _libc_function('sendfile64',
+                           [ctypes.c_int, ctypes.c_int,
+                            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t],
+                           ctypes.c_ssize_t)
+
+# the errors with which copy_file_range() and sendfile() say that they cannot
+# copy between this pair of files, rather than that the copy failed
+_COPY_FALLBACK_ERRNOS = frozenset([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP])
+
+def _fadvise(fd, offset, length, advice):
+    """
+    Internal function to give the kernel a hint about how fd will be accessed.
+    The hint is purely advisory, so this silently does nothing if
+    posix_fadvise() is unavailable or fails.
+    """
+    if _posix_fadvise is not None:
+        _posix_fadvise(fd, offset, length, advice)
+
+def _kernel_copy_file_range(src_fd, dest_fd, offset, length):
+    """
+    Internal function to copy up to length bytes at offset from src_fd to the
+    same offset in dest_fd with copy_file_range(), without the data passing
+    through userspace.  Returns the number of bytes copied, which may be
+    short.
+    """
+    if _copy_file_range is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    while True:
+        src_off = ctypes.c_int64(offset)
+        dest_off = ctypes.c_int64(offset)
+        ret = _copy_file_range(src_fd, ctypes.byref(src_off), dest_fd,
+                               ctypes.byref(dest_off), length, 0)
+        if ret >= 0:
+            return ret
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+def _kernel_sendfile(src_fd, dest_fd, offset, length):
+    """
+    Internal function to copy up to length bytes at offset from src_fd to the
+    current position of dest_fd with sendfile(), without the data passing
+    through userspace.  Returns the number of bytes copied, which may be
+    short.
+    """
+    if _sendfile is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    while True:
+        src_off = ctypes.c_int64(offset)
+        ret = _sendfile(dest_fd, src_fd, ctypes.byref(src_off), length)
+        if ret >= 0:
+            return ret
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+def _copy_extent(src_fd, dest_fd, offset, length, buf_size):
+    """
+    Internal function to copy length bytes starting at offset from src_fd to
+    the same offset in dest_fd.  The copy is done in the kernel with
+    copy_file_range() or sendfile() where possible, falling back to copying
+    buf_size bytes at a time through userspace.
+    """
+    # the in-kernel copies are done in bounded chunks, so that the source
+    # pages can be dropped from the page cache as we go
+    copyfuncs = [_kernel_copy_file_range, _kernel_sendfile]
+    while length > 0 and copyfuncs:
+        os.lseek(dest_fd, offset, os.SEEK_SET)
+        try:
+            num = copyfuncs[0](src_fd, dest_fd, offset,
+                               min(8*buf_size, length))
+        except OSError as err:
+            if err.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+            copyfuncs.pop(0)
+            continue
+        if num == 0:
+            return
+        _fadvise(src_fd, offset, num, POSIX_FADV_DONTNEED)
+        offset += num
+        length -= num
+
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    while length > 0:
+        buf = read_bytes_from_fd(src_fd, min(buf_size, length))
+        if len(buf) == 0:
+            break
+        write_bytes_to_fd(dest_fd, buf)
+        _fadvise(src_fd, offset, len(buf), POSIX_FADV_DONTNEED)
+        offset += len(buf)
+        length -= len(buf)
+
+def _copy_data_extents(src_fd, dest_fd, sb):
+    """
+    Internal function to copy only the allocated extents of src_fd to
+    dest_fd, using SEEK_DATA and SEEK_HOLE to skip over the holes.  Raises
+    OSError with EINVAL if the underlying filesystem does not support them.
+    """
+    buf_size = max(1024*1024, sb.st_blksize)
+
+    pos = 0
+    while pos < sb.st_size:
+        try:
+            data = os.lseek(src_fd, pos, SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # no more data past pos; the rest of the file is a hole
+                break
+            raise
+        hole = os.lseek(src_fd, data, SEEK_HOLE)
+
+        _copy_extent(src_fd, dest_fd, data, hole - data, buf_size)
+
+        pos = hole
+
+def _copy_scan_zeros(src_fd, dest_fd, sb):
+    """
+    Internal function to copy src_fd to dest_fd by reading the whole file
+    and seeking over any all-zero blocks.  This is the fallback for
+    filesystems that do not support SEEK_DATA and SEEK_HOLE.
+    """
+    blk_size = max(512, sb.st_blksize)
+    buf_size = max(1024*1024, blk_size)
+
+    # allocate the zero buffers once, rather than on every comparison
+    zero_buf = '\0'*buf_size
+    zero_blk = '\0'*blk_size
+
+    pos = 0
+    size = sb.st_size
+    while size != 0:
+        buf = read_bytes_from_fd(src_fd, min(buf_size, size))
+        if len(buf) == 0:
+            break
+
+        buflen = len(buf)
+        if buflen == buf_size and buf == zero_buf:
+            os.lseek(dest_fd, buflen, os.SEEK_CUR)
+        else:
+            # walk the buffer a block at a time, so that zero blocks in a
+            # partially filled buffer still end up as holes.  Adjacent data
+            # blocks are coalesced into a single write
+            start = 0
+            offset = 0
+            while offset < buflen:
+                end = min(offset + blk_size, buflen)
+                if buf[offset:end] == zero_blk[:end - offset]:
+                    if start < offset:
+                        write_bytes_to_fd(dest_fd, buf[start:offset])
+                    os.lseek(dest_fd, end - offset, os.SEEK_CUR)
+                    start = end
+                offset = end
+            if start < buflen:
+                write_bytes_to_fd(dest_fd, buf[start:])
+
+        _fadvise(src_fd, pos, buflen, POSIX_FADV_DONTNEED)
+        pos += buflen
+        size -= buflen
+
 def copyfile_sparse(src, dest):
     """
-    Function to copy a file sparsely if possible.  The logic here is
-    all taken from coreutils cp, specifically the 'sparse_copy' function.
+    Function to copy a file sparsely if possible.  If the filesystem supports
+    SEEK_DATA and SEEK_HOLE, only the allocated extents of the source are
+    copied.  Otherwise the logic is all taken from coreutils cp, specifically
+    the 'sparse_copy' function.
     """
     if src is None:
         raise Exception("Source of copy cannot be None")
@@ -148,116 +406,78 @@ def copyfile_sparse(src, dest):
         try:
             sb = os.fstat(src_fd)
 
-            # See io_blksize() in coreutils for an explanation of why 32*1024
-            buf_size = max(32*1024, sb.st_blksize)
-
-            size = sb.st_size
-            destlen = 0
-            while size != 0:
-                buf = read_bytes_from_fd(src_fd, min(buf_size, size))
-                if len(buf) == 0:
-                    break
-
-                buflen = len(buf)
-                if buf == '\0'*buflen:
-                    os.lseek(dest_fd, buflen, os.SEEK_CUR)
-                else:
-                    write_bytes_to_fd(dest_fd, buf)
-
-                destlen += buflen
-                size -= buflen
-
-            os.ftruncate(dest_fd, destlen)
+            # the source is read once from start to finish, and none of it
+            # (nor the destination) will be needed again soon.  Tell the
+            # kernel, so that it reads ahead aggressively and so that copying
+            # a large image does not push everything else out of the page
+            # cache
+            _fadvise(src_fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+            try:
+                _copy_data_extents(src_fd, dest_fd, sb)
+            except OSError as err:
+                if err.errno != errno.EINVAL:
+                    raise
+                # SEEK_DATA/SEEK_HOLE are not supported here, so start over
+                # and scan the whole file for zeros instead
+                os.ftruncate(dest_fd, 0)
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dest_fd, 0, os.SEEK_SET)
+                _copy_scan_zeros(src_fd, dest_fd, sb)
+
+            os.ftruncate(dest_fd, sb.st_size)
+            _fadvise(dest_fd, 0, 0, POSIX_FADV_DONTNEED)
 
         finally:
             os.close(dest_fd)
     finally:
         os.close(src_fd)
 
+# a BSD-style checksum line looks like "SHA256 (filename) = digest".  The BSD
+# 'md5' and 'sha1' commands do not escape filenames, so the greedy match on
+# the filename finds the last ')'
+_BSD_SUM_RE = re.compile(r'^(MD5|SHA1|SHA256) ?\((.*)\)\s*=\s*([0-9a-fA-F]+)\s*$')
+
+# a normal Linux checksum line looks like "digest *filename", with the whole
+# line prefixed by a '\\' if the filename is escaped.  These depend on the
+# length of the digest, so they are compiled on demand by _sum_regex()
+_sum_res = {}
+
+def _sum_regex(digest_hex_bytes):
+    """
+    Internal function to get the compiled regular expression for a normal
+    Linux checksum line with a digest of digest_hex_bytes hex characters.
+    """
+    try:
+        return _sum_res[digest_hex_bytes]
+    except KeyError:
+        regex = re.compile(r'^(\\?)([0-9a-fA-F]{%d})[ \t][ *](.+)$' % (digest_hex_bytes))
+        _sum_res[digest_hex_bytes] = regex
+        return regex
+
 def bsd_split(line, digest_type):
     """
     Function to split a BSD-style checksum line into a filename and
     checksum.
     """
-    current = len(digest_type)
-
-    if line[current] == ' ':
-        current += 1
-
-    if line[current] != '(':
-        return None, None
-
-    current += 1
-
-    # find end of filename.  The BSD 'md5' and 'sha1' commands do not escape
-    # filenames, so search backwards for the last ')'
-    file_end = line.rfind(')')
-    if file_end == -1:
-        # could not find the ending ), fail
-        return None, None
-
-    filename = line[current:file_end]
-
-    line = line[(file_end + 1):]
-    line = line.lstrip()
-
-    if line[0] != '=':
+    match = _BSD_SUM_RE.match(line)
+    if match is None or match.group(1) != digest_type:
         return None, None
 
-    line = line[1:]
-
-    line = line.lstrip()
-    if line[-1] == '\n':
-        line = line[:-1]
-
-    return line, filename
+    return match.group(3), match.group(2)
 
-def sum_split(line, digest_bits):
+def sum_split(line, digest_hex_bytes):
     """
     Function to split a normal Linux checksum line into a filename and
-    checksum.
+    checksum.  digest_hex_bytes is the length of the hex message digest.
     """
-    digest_hex_bytes = digest_bits / 4
-    min_digest_line_length = digest_hex_bytes + 2 + 1 # length of hex message digest + blank and binary indicator (2 bytes) + minimum file length (1 byte)
-
-    min_length = min_digest_line_length
-    if line[0] == '\\':
-        min_length = min_length + 1
-    if len(line) < min_length:
-        # if the line is too short, skip it
-        return None, None
-
-    if line[0] == '\\':
-        current = digest_hex_bytes + 1
-        hex_digest = line[1:current]
-        escaped_filename = True
-    else:
-        current = digest_hex_bytes
-        hex_digest = line[0:current]
-        escaped_filename = False
-
-    # if the digest is not immediately followed by a white space, it is an
-    # error
-    if line[current] != ' ' and line[current] != '\t':
-        return None, None
-
-    current += 1
-    # if the whitespace is not immediately followed by another space or a *,
-    # it is an error
-    if line[current] != ' ' and line[current] != '*':
+    match = _sum_regex(digest_hex_bytes).match(line)
+    if match is None:
         return None, None
 
-    if line[current] == '*':
-        binary = True
+    escape, hex_digest, filename = match.groups()
 
-    current += 1
-
-    if line[-1] == '\n':
-        filename = line[current:-1]
-    else:
-        filename = line[current:]
-
-    if escaped_filename:
+    if escape:
         # FIXME: a \0 is not allowed in the sum file format, but
         # string_escape allows it.  We'd probably have to implement our
         # own codec to fix this
@@ -272,37 +492,47 @@ def get_sum_from_file(sumfile, file_to_find, digest_bits, digest_type):
     """
     retval = None
 
-    f = open(sumfile, 'r')
-    for line in f:
-        binary = False
+    # these are the same for every line, so work them out up front
+    digest_type_len = len(digest_type)
+    digest_hex_bytes = digest_bits >> 2
 
-        # remove any leading whitespace
-        line = line.lstrip()
+    f = open(sumfile, 'rb', 1024*1024)
+    try:
+        for line in f:
+            # the filename has to appear verbatim on any line we are
+            # interested in, so skip everything else before doing the
+            # (expensive) parsing.  The exception is escaped filenames,
+            # which always contain a '\\'
+            if file_to_find not in line and '\\' not in line:
+                continue
 
-        # ignore blank lines
-        if len(line) == 0:
-            continue
+            # remove any leading whitespace
+            line = line.lstrip()
 
-        # ignore comment lines
-        if line[0] == '#':
-            continue
+            # ignore blank lines
+            if len(line) == 0:
+                continue
 
-        if line.startswith(digest_type):
-            # OK, if it starts with a string of ["MD5", "SHA1", "SHA256"], then
-            # this is a BSD-style sumfile
-            hex_digest, filename = bsd_split(line, digest_type)
-        else:
-            # regular sumfile
-            hex_digest, filename = sum_split(line, digest_bits)
+            # ignore comment lines
+            if line[0] == '#':
+                continue
 
-        if hex_digest is None or filename is None:
-            continue
+            if line[:digest_type_len] == digest_type:
+                # OK, if it starts with a string of ["MD5", "SHA1", "SHA256"],
+                # then this is a BSD-style sumfile
+                hex_digest, filename = bsd_split(line, digest_type)
+            else:
+                # regular sumfile
+                hex_digest, filename = sum_split(line, digest_hex_bytes)
 
-        if filename == file_to_find:
-            retval = hex_digest
-            break
+            if hex_digest is None or filename is None:
+                continue
 
-    f.close()
+            if filename == file_to_find:
+                retval = hex_digest
+                break
+    finally:
+        f.close()
 
     return retval
 
@@ -325,6 +555,58 @@ def get_sha256sum_from_file(sumfile, file_to_find):
     """
     return get_sum_from_file(sumfile, file_to_find, 256, "SHA256")
 
+def hash_fd(fd, digest_name, bufsize=4*1024*1024):
+    """
+    Function to calculate the hex digest of the data in fd, from the current
+    position to the end of the file.  digest_name is any name understood by
+    hashlib.new(), e.g. 'md5', 'sha1' or 'sha256'.
+    """
+    if bufsize <= 0:
+        raise Exception("Buffer size must be positive, not %d" % (bufsize))
+
+    digest = hashlib.new(digest_name)
+
+    # read into a single preallocated buffer, and hand slices of it to the
+    # hash through a memoryview, so that no per-chunk strings are allocated
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    f = io.FileIO(fd, 'r', closefd=False)
+    try:
+        while True:
+            try:
+                num = f.readinto(buf)
+            except (IOError, OSError) as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            if not num:
+                break
+            digest.update(view[:num])
+    finally:
+        f.close()
+
+    return digest.hexdigest()
+
+def hash_file(path, digest_name, bufsize=4*1024*1024):
+    """
+    Function to calculate the hex digest of the file at path.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return hash_fd(fd, digest_name, bufsize)
+    finally:
+        os.close(fd)
+
+def verify_sum(path, expected_hex, digest_name):
+    """
+    Function to check that the file at path has the hex digest expected_hex.
+    Returns True if it does, and False otherwise.
+    """
+    return hash_file(path, digest_name) == expected_hex.lower()
+
+_TRUE_STRINGS = frozenset(('yes', 'true'))
+_FALSE_STRINGS = frozenset(('no', 'false'))
+
 def string_to_bool(instr):
     """
     Function to take a string and determine whether it is True, Yes, False,
@@ -336,19 +618,19 @@ def string_to_bool(instr):
     if instr is None:
         raise Exception("Input string was None!")
     lower = instr.lower()
-    if lower == 'no' or lower == 'false':
-        return False
-    if lower == 'yes' or lower == 'true':
+    if lower in _TRUE_STRINGS:
         return True
+    if lower in _FALSE_STRINGS:
+        return False
     return None
 
 def generate_macaddress():
     """
     Function to generate a random MAC address.
     """
-    mac = [0x52, 0x54, 0x00, random.randint(0x00, 0xff),
-           random.randint(0x00, 0xff), random.randint(0x00, 0xff)]
-    return ':'.join(["%02x" % x for x in mac])
+    # 52:54:00 is the prefix reserved for QEMU/KVM; the rest comes straight
+    # from the kernel random number generator
+    return "52:54:00:%02x:%02x:%02x" % tuple(bytearray(os.urandom(3)))
 
 class SubprocessException(Exception):
     """
@@ -359,9 +641,15 @@ class SubprocessException(Exception):
         Exception.__init__(self, msg)
         self.retcode = retcode
 
+# only the tail of stderr is interesting for error messages, so this is the
+# most that subprocess_check_output() keeps of it
+_STDERR_TAIL_SIZE = 64*1024
+
 def subprocess_check_output(*popenargs, **kwargs):
     """
-    Function to call a subprocess and gather the output.
+    Function to call a subprocess and gather the output.  All of stdout is
+    returned, but only the last 64KiB of stderr is kept, so that chatty
+    commands do not use unbounded amounts of memory.
     """
     if 'stdout' in kwargs:
         raise ValueError('stdout argument not allowed, it will be overridden.')
@@ -382,12 +670,14 @@ def subprocess_check_output(*popenargs, **kwargs):
     select_POLLIN_POLLPRI = select.POLLIN | select.POLLPRI
     poller.register(process.stdout.fileno(), select_POLLIN_POLLPRI)
     poller.register(process.stderr.fileno(), select_POLLIN_POLLPRI)
+    registered = 2
 
-    stdout = ''
+    # read both pipes until they are closed, rather than handing them to
+    # communicate(), so that stderr is trimmed as it arrives instead of
+    # being held in memory in full
+    stdout = []
     stderr = ''
-    retcode = process.poll()
-    while retcode is None:
-        start = time.time()
+    while registered > 0:
         try:
             ready = poller.poll(1000)
         except select.error, e:
@@ -397,33 +687,41 @@ def subprocess_check_output(*popenargs, **kwargs):
 
         for fd, mode in ready:
             if mode & select_POLLIN_POLLPRI:
-                data = os.read(fd, 4096)
+                data = os.read(fd, 65536)
                 if not data:
                     poller.unregister(fd)
+                    registered -= 1
                 else:
                     if printfn is not None:
                         printfn(data)
                     if fd == process.stdout.fileno():
-                        stdout += data
+                        stdout.append(data)
                     else:
-                        stderr += data
+                        stderr = _stderr_tail(stderr, data)
             else:
                 # Ignore hang up or errors.
                 poller.unregister(fd)
+                registered -= 1
 
-        end = time.time()
-        if (end - start) < 1:
-            time.sleep(1 - (end - start))
-        retcode = process.poll()
+    process.stdout.close()
+    process.stderr.close()
+    retcode = process.wait()
 
-    tmpout, tmperr = process.communicate()
+    return _subprocess_check_retcode(popenargs, ''.join(stdout), stderr,
+                                     retcode)
 
-    stdout += tmpout
-    stderr += tmperr
-    if printfn is not None:
-        printfn(tmperr)
-        printfn(tmpout)
+def _stderr_tail(stderr, data):
+    """
+    Internal function to append data to the stderr collected so far by
+    subprocess_check_output(), keeping only the last _STDERR_TAIL_SIZE bytes.
+    """
+    return (stderr + data)[-_STDERR_TAIL_SIZE:]
 
+def _subprocess_check_retcode(popenargs, stdout, stderr, retcode):
+    """
+    Internal function to raise a SubprocessException if a command run by
+    subprocess_check_output() failed, and to return its output otherwise.
+    """
     if retcode:
         cmd = ' '.join(*popenargs)
         raise SubprocessException("'%s' failed(%d): %s" % (cmd, retcode, stderr), retcode)
@@ -502,25 +800,29 @@ def copy_modify_file(inname, outname, subfunc):
     Function to copy a file from inname to outname, passing each line
     through subfunc first.  subfunc is expected to be a method that takes
     a single argument in (the next line), and returns a string to be
-    written to the output file after modification (if any).
+    written to the output file after modification (if any).  If subfunc is
+    None, the file is copied unmodified.
     """
     if inname is None:
         raise Exception("input filename is None")
     if outname is None:
         raise Exception("output filename is None")
-    if subfunc is None:
-        raise Exception("subfunction is None")
-    if not isinstance(subfunc, collections.Callable):
+    if subfunc is not None and not isinstance(subfunc, collections.Callable):
         raise Exception("subfunction is not callable")
 
-    infile = open(inname, 'r')
-    outfile = open(outname, 'w')
-
-    for line in infile:
-        outfile.write(subfunc(line))
-
-    infile.close()
-    outfile.close()
+    infile = open(inname, 'r', 1024*1024)
+    try:
+        outfile = open(outname, 'w', 1024*1024)
+        try:
+            if subfunc is None:
+                shutil.copyfileobj(infile, outfile, 1024*1024)
+            else:
+                for line in infile:
+                    outfile.write(subfunc(line))
+        finally:
+            outfile.close()
+    finally:
+        infile.close()
 
 def write_cpio(inputdict, outputfile):
     """
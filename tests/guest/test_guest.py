@@ -12,6 +12,8 @@ except:
     BytesIO = StringIO
 import logging
 import os
+import stat
+import subprocess
 
 # Find oz library
 prefix = '.'
@@ -380,3 +382,156 @@ def test_geteltorito_bogus_bootp(tmpdir):
 
     with py.test.raises(Exception):
         guest._geteltorito(src, dst)
+
+def test_live_upload(tmpdir, monkeypatch):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    src = os.path.join(str(tmpdir), 'my file')
+    open(src, 'w').write('contents')
+    os.chmod(src, 0o600)
+
+    calls = []
+    def check_output(*args, **kwargs):
+        calls.append((args, kwargs))
+        # the contents must be fed to the remote cat on stdin
+        assert(kwargs['stdin'].read() == 'contents')
+        return ('', '', 0)
+    monkeypatch.setattr(oz.ozutil, 'subprocess_check_output', check_output)
+
+    guest.guest_live_upload('192.168.122.2', src, '/root/my dir/my file')
+
+    # the upload is a single ssh call, with the destination quoted
+    assert(len(calls) == 1)
+    args, kwargs = calls[0]
+    argv = args[0]
+    assert(argv[0] == 'ssh')
+    assert(argv[-2] == 'root@192.168.122.2')
+    assert(argv[-1] == "mkdir -p '/root/my dir' && cat > '/root/my dir/my file' && chmod 600 '/root/my dir/my file'")
+    assert(kwargs['stdin'].closed)
+
+tdlxml_commands = """
+<template>
+  <name>tester</name>
+  <os>
+    <name>Fedora</name>
+    <version>14</version>
+    <arch>x86_64</arch>
+    <install type='url'>
+      <url>http://download.fedoraproject.org/pub/fedora/linux//releases/14/Fedora/x86_64/os/</url>
+    </install>
+  </os>
+  <commands>
+    <command name='cmd1'>echo hello</command>
+  </commands>
+</template>
+"""
+
+class FakeDomain(object):
+    def destroy(self):
+        pass
+
+class FakeConn(object):
+    def createXML(self, xml, flags):
+        return FakeDomain()
+
+def setup_mux_guest(monkeypatch, mux_retcode):
+    """
+    Set up a guest whose customization runs one command over ssh, with
+    libvirt and the guest itself faked out.  Returns the guest and a list
+    that collects (argv, mux dir) for every ssh call.
+    """
+    tdl = oz.TDL.TDL(tdlxml_commands)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    guest.libvirt_conn = FakeConn()
+
+    monkeypatch.setattr(guest, '_modify_libvirt_xml_for_serial',
+                        lambda xml: xml)
+    monkeypatch.setattr(guest, '_collect_setup', lambda xml: None)
+    monkeypatch.setattr(guest, '_collect_teardown', lambda xml: None)
+    monkeypatch.setattr(guest, '_wait_for_guest_boot',
+                        lambda dom: '192.168.122.2')
+    monkeypatch.setattr(guest, '_test_ssh_connection', lambda addr: None)
+    monkeypatch.setattr(guest, 'do_customize',
+                        lambda addr: guest.guest_execute_command(addr, 'ls'))
+
+    calls = []
+    def call(argv, **kwargs):
+        calls.append((argv, guest._ssh_mux_dir))
+        return mux_retcode
+    monkeypatch.setattr(subprocess, 'call', call)
+
+    def check_output(*args, **kwargs):
+        argv = args[0]
+        calls.append((argv, guest._ssh_mux_dir))
+        if '-O' in argv and mux_retcode != 0:
+            # there is no master to tell to exit
+            raise oz.ozutil.SubprocessException('no master', 255)
+        return ('', '', 0)
+    monkeypatch.setattr(oz.ozutil, 'subprocess_check_output', check_output)
+
+    return guest, calls
+
+def check_mux_calls(calls):
+    # the master, the customization command and the exit request, all using
+    # a socket in the same private directory
+    assert(len(calls) == 3)
+    assert(calls[0][0][-1] == 'root@192.168.122.2')
+    assert('ControlMaster=yes' in calls[0][0])
+    assert(calls[1][0][-1] == 'ls')
+    assert(calls[2][0][-2:] == ['exit', 'root@192.168.122.2'])
+
+    muxdir = calls[0][1]
+    assert(muxdir is not None)
+    assert(os.path.basename(muxdir).startswith('oz-ssh-'))
+    for argv, calldir in calls:
+        assert(argv[0] == 'ssh')
+        assert(calldir == muxdir)
+        assert('ControlPath=' + os.path.join(muxdir, '%r@%h:%p') in argv)
+
+    # the directory goes away with the master
+    assert(not os.path.exists(muxdir))
+
+def test_ssh_mux_lifecycle(monkeypatch):
+    guest, calls = setup_mux_guest(monkeypatch, 0)
+    def shutdown_guest(addr, dom):
+        # the directory must be private while the master is using it
+        assert(stat.S_IMODE(os.stat(guest._ssh_mux_dir).st_mode) == 0o700)
+    monkeypatch.setattr(guest, '_shutdown_guest', shutdown_guest)
+
+    guest.customize('<domain/>')
+
+    check_mux_calls(calls)
+    assert(guest._ssh_mux_dir is None)
+
+def test_ssh_mux_shutdown_fails(monkeypatch):
+    guest, calls = setup_mux_guest(monkeypatch, 0)
+    def shutdown_guest(addr, dom):
+        raise oz.OzException.OzException('shutdown failed')
+    monkeypatch.setattr(guest, '_shutdown_guest', shutdown_guest)
+
+    with py.test.raises(oz.OzException.OzException):
+        guest.customize('<domain/>')
+
+    # the master must still have been told to exit
+    check_mux_calls(calls)
+    assert(guest._ssh_mux_dir is None)
+
+def test_ssh_mux_open_fails(monkeypatch):
+    # failing to start the master is not fatal; the commands connect on
+    # their own, and the attempt to stop the master is allowed to fail
+    guest, calls = setup_mux_guest(monkeypatch, 255)
+    monkeypatch.setattr(guest, '_shutdown_guest', lambda addr, dom: None)
+
+    guest.customize('<domain/>')
+
+    check_mux_calls(calls)
+    assert(guest._ssh_mux_dir is None)
@@ -2,6 +2,8 @@
 
 import sys
 import os
+import errno
+import ctypes
 
 try:
     import py.test
@@ -55,6 +57,18 @@ def test_exe_exists_none():
     with py.test.raises(Exception):
         oz.ozutil.executable_exists(None)
 
+def test_exe_exists_cached(tmpdir):
+    fullname = os.path.join(str(tmpdir), 'exe')
+    open(fullname, 'w').write('#!/bin/sh\n')
+    os.chmod(fullname, 0o755)
+    assert(oz.ozutil.executable_exists(fullname) == fullname)
+    os.unlink(fullname)
+    # the result is cached until the cache is invalidated
+    assert(oz.ozutil.executable_exists(fullname) == fullname)
+    oz.ozutil.invalidate_exe_cache()
+    with py.test.raises(Exception):
+        oz.ozutil.executable_exists(fullname)
+
 # test oz.ozutil.copyfile_sparse
 def test_copy_sparse_none_src():
     with py.test.raises(Exception):
@@ -148,6 +162,150 @@ def test_copy_sparse_zero_blocks(tmpdir):
     dstname = os.path.join(str(tmpdir), 'dst')
     oz.ozutil.copyfile_sparse(srcname, dstname)
 
+def test_copy_sparse_holes(tmpdir):
+    infd = open('/dev/urandom', 'r')
+    data1 = infd.read(32*1024)
+    data2 = infd.read(32*1024)
+    infd.close()
+
+    # leave a hole in the middle and at the end of the file
+    srcname = os.path.join(str(tmpdir), 'src')
+    outfd = open(srcname, 'w')
+    outfd.write(data1)
+    outfd.seek(4*1024*1024)
+    outfd.write(data2)
+    outfd.truncate(8*1024*1024)
+    outfd.close()
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname)
+
+    assert(open(dstname, 'r').read() == open(srcname, 'r').read())
+    # the holes must have been preserved, not filled in
+    assert(os.stat(dstname).st_blocks <= os.stat(srcname).st_blocks)
+
+def test_copy_sparse_scan_zeros(tmpdir, monkeypatch):
+    infd = open('/dev/urandom', 'r')
+    data1 = infd.read(64*1024)
+    data2 = infd.read(64*1024)
+    data3 = infd.read(1000)
+    infd.close()
+
+    # write the zeros out explicitly, so that the source is fully allocated.
+    # The first buffer mixes data, zero and data blocks, the second buffer
+    # is all zeros, and the file ends in a partial block
+    srcname = os.path.join(str(tmpdir), 'src')
+    outfd = open(srcname, 'w')
+    outfd.write(data1)
+    outfd.write('\0'*64*1024)
+    outfd.write(data2)
+    outfd.write('\0'*(2*1024*1024 - 3*64*1024))
+    outfd.write(data3)
+    outfd.close()
+
+    # pretend that the filesystem does not support SEEK_DATA/SEEK_HOLE
+    def no_seek_data(src_fd, dest_fd, sb):
+        raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+    monkeypatch.setattr(oz.ozutil, '_copy_data_extents', no_seek_data)
+
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname)
+
+    assert(open(dstname, 'r').read() == open(srcname, 'r').read())
+    # only the data blocks should have been allocated
+    assert(os.stat(dstname).st_blocks*512 <= 256*1024)
+    assert(os.stat(dstname).st_blocks < os.stat(srcname).st_blocks)
+
+def _make_dense_src(tmpdir):
+    infd = open('/dev/urandom', 'r')
+    data = infd.read(3*1024*1024 + 1000)
+    infd.close()
+
+    srcname = os.path.join(str(tmpdir), 'src')
+    open(srcname, 'w').write(data)
+    return srcname
+
+def _failing_libc_call(err):
+    # behaves like a C library call that fails and sets errno
+    def fail(*args):
+        ctypes.set_errno(err)
+        return -1
+    return fail
+
+def _counting(monkeypatch, name):
+    calls = []
+    func = getattr(oz.ozutil, name)
+    def count(*args):
+        calls.append(args)
+        return func(*args)
+    monkeypatch.setattr(oz.ozutil, name, count)
+    return calls
+
+def test_copy_sparse_copy_file_range(tmpdir, monkeypatch):
+    if oz.ozutil._copy_file_range is None:
+        py.test.skip('copy_file_range() is not available')
+    srcname = _make_dense_src(tmpdir)
+    calls = _counting(monkeypatch, '_kernel_copy_file_range')
+    reads = _counting(monkeypatch, 'read_bytes_from_fd')
+
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname)
+
+    assert(open(dstname, 'r').read() == open(srcname, 'r').read())
+    assert(len(calls) > 0)
+    assert(len(reads) == 0)
+
+@py.test.mark.parametrize('err', [errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                  errno.EOPNOTSUPP])
+def test_copy_sparse_sendfile_fallback(tmpdir, monkeypatch, err):
+    if oz.ozutil._sendfile is None:
+        py.test.skip('sendfile() is not available')
+    srcname = _make_dense_src(tmpdir)
+    monkeypatch.setattr(oz.ozutil, '_copy_file_range', _failing_libc_call(err))
+    calls = _counting(monkeypatch, '_kernel_sendfile')
+    reads = _counting(monkeypatch, 'read_bytes_from_fd')
+
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname)
+
+    assert(open(dstname, 'r').read() == open(srcname, 'r').read())
+    assert(len(calls) > 0)
+    assert(len(reads) == 0)
+
+@py.test.mark.parametrize('err', [errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                  errno.EOPNOTSUPP])
+def test_copy_sparse_read_write_fallback(tmpdir, monkeypatch, err):
+    srcname = _make_dense_src(tmpdir)
+    monkeypatch.setattr(oz.ozutil, '_copy_file_range', _failing_libc_call(err))
+    monkeypatch.setattr(oz.ozutil, '_sendfile', _failing_libc_call(err))
+    reads = _counting(monkeypatch, 'read_bytes_from_fd')
+
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname)
+
+    assert(open(dstname, 'r').read() == open(srcname, 'r').read())
+    assert(len(reads) > 0)
+
+def test_copy_sparse_no_kernel_copy(tmpdir, monkeypatch):
+    # the C library may not have copy_file_range() or sendfile() at all
+    srcname = _make_dense_src(tmpdir)
+    monkeypatch.setattr(oz.ozutil, '_copy_file_range', None)
+    monkeypatch.setattr(oz.ozutil, '_sendfile', None)
+
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname)
+
+    assert(open(dstname, 'r').read() == open(srcname, 'r').read())
+
+def test_copy_sparse_kernel_copy_error(tmpdir, monkeypatch):
+    # other errors are real failures, and must not be papered over
+    srcname = _make_dense_src(tmpdir)
+    monkeypatch.setattr(oz.ozutil, '_copy_file_range',
+                        _failing_libc_call(errno.EIO))
+
+    dstname = os.path.join(str(tmpdir), 'dst')
+    with py.test.raises(OSError):
+        oz.ozutil.copyfile_sparse(srcname, dstname)
+
 def test_copy_sparse_src_not_exists(tmpdir):
     srcname = os.path.join(str(tmpdir), 'src')
     dstname = os.path.join(str(tmpdir), 'dst')
@@ -213,10 +371,23 @@ def test_stb_invalid():
     if oz.ozutil.string_to_bool('foobar') != None:
         raise Exception("Expected None return from string_to_bool")
 
+def test_stb_values():
+    for curr in ['yes', 'Yes', 'TRUE', 'true']:
+        assert(oz.ozutil.string_to_bool(curr) is True)
+    for curr in ['no', 'NO', 'False', 'false']:
+        assert(oz.ozutil.string_to_bool(curr) is False)
+
 # test oz.ozutil.generate_macaddress
 def test_genmac():
     oz.ozutil.generate_macaddress()
 
+def test_genmac_format():
+    mac = oz.ozutil.generate_macaddress()
+    assert(len(mac) == 17)
+    assert(mac.startswith('52:54:00:'))
+    for octet in mac.split(':'):
+        int(octet, 16)
+
 # test oz.ozutil.mkdir_p
 def test_mkdir_p(tmpdir):
     fullname = os.path.join(str(tmpdir), 'foo')
@@ -252,11 +423,19 @@ def test_copy_modify_none_dst(tmpdir):
         oz.ozutil.copy_modify_file(fullname, None, None)
 
 def test_copy_modify_none_subfunc(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'w').write('src')
+    dst = os.path.join(str(tmpdir), 'dst')
+    # with no subfunction, the file is copied unmodified
+    oz.ozutil.copy_modify_file(src, dst, None)
+    assert(open(dst, 'r').read() == 'src')
+
+def test_copy_modify_not_callable_subfunc(tmpdir):
     src = os.path.join(str(tmpdir), 'src')
     open(src, 'w').write('src')
     dst = os.path.join(str(tmpdir), 'dst')
     with py.test.raises(Exception):
-        oz.ozutil.copy_modify_file(src, dst, None)
+        oz.ozutil.copy_modify_file(src, dst, 'sub')
 
 def test_copy_modify_bad_src_mode(tmpdir):
     if os.geteuid() == 0:
@@ -446,3 +625,124 @@ def test_md5sum_regular_no_space(tmpdir):
     f.close()
 
     oz.ozutil.get_md5sum_from_file(src, 'Fedora-11-i386-DVD.iso')
+
+def test_sha256sum_multiple_files(tmpdir):
+    src = os.path.join(str(tmpdir), 'sha256sum')
+    f = open(src, 'w')
+    f.write('1f8e7b4a8d1e9e4b6e0c5ad1c81f2b8a2e0e1f3c5d7b9a1c3e5f7a9b1d3f5a7c *Fedora-11-i386-netinst.iso\n')
+    f.write('6e812e782e52b536c0307bb26b3c244e1c42b644235f5a4b242786b1ef375358 *Fedora-11-i386-DVD.iso\n')
+    f.close()
+
+    assert(oz.ozutil.get_sha256sum_from_file(src, 'Fedora-11-i386-DVD.iso') == '6e812e782e52b536c0307bb26b3c244e1c42b644235f5a4b242786b1ef375358')
+    assert(oz.ozutil.get_sha256sum_from_file(src, 'Fedora-11-x86_64-DVD.iso') is None)
+
+# test oz.ozutil.subprocess_check_output
+def test_subprocess_check_output():
+    stdout, stderr, retcode = oz.ozutil.subprocess_check_output(['sh', '-c', 'echo out; echo err >&2'])
+    assert(stdout == 'out\n')
+    assert(stderr == 'err\n')
+    assert(retcode == 0)
+
+def test_subprocess_check_output_printfn():
+    printed = []
+    stdout, stderr, retcode = oz.ozutil.subprocess_check_output(['sh', '-c', 'echo out; echo err >&2'],
+                                                                printfn=printed.append)
+    assert(stdout == 'out\n')
+    assert(stderr == 'err\n')
+    assert(''.join(printed).count('out\n') == 1)
+
+def test_subprocess_check_output_fail():
+    with py.test.raises(oz.ozutil.SubprocessException):
+        oz.ozutil.subprocess_check_output(['false'])
+
+def test_md5sum_bsd_value(tmpdir):
+    src = os.path.join(str(tmpdir), 'md5sum')
+    f = open(src, 'w')
+    f.write('MD5 (Fedora-11-i386-DVD.iso) = 6e812e782e52b536c0307bb26b3c244e\n')
+    f.close()
+
+    assert(oz.ozutil.get_md5sum_from_file(src, 'Fedora-11-i386-DVD.iso') == '6e812e782e52b536c0307bb26b3c244e')
+
+def test_md5sum_regular_escaped_value(tmpdir):
+    src = os.path.join(str(tmpdir), 'md5sum')
+    f = open(src, 'w')
+    f.write('\\6e812e782e52b536c0307bb26b3c244e *Fedora\\\\11.iso\n')
+    f.close()
+
+    assert(oz.ozutil.get_md5sum_from_file(src, 'Fedora\\11.iso') == '6e812e782e52b536c0307bb26b3c244e')
+
+# test oz.ozutil.hash_file
+def test_hash_file(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'w').write('abc')
+
+    assert(oz.ozutil.hash_file(src, 'md5') == '900150983cd24fb0d6963f7d28e17f72')
+    # make sure that data spanning several buffers is hashed correctly
+    assert(oz.ozutil.hash_file(src, 'sha1', bufsize=2) == 'a9993e364706816aba3e25717850c26c9cd0d89d')
+
+def test_hash_file_is_dir(tmpdir):
+    with py.test.raises(Exception):
+        oz.ozutil.hash_file(str(tmpdir), 'md5')
+
+def test_hash_fd_bad_fd(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    fd = os.open(src, os.O_WRONLY|os.O_CREAT)
+    try:
+        with py.test.raises(Exception):
+            oz.ozutil.hash_fd(fd, 'md5')
+    finally:
+        os.close(fd)
+
+def test_hash_file_bad_bufsize(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'w').write('abc')
+    with py.test.raises(Exception):
+        oz.ozutil.hash_file(src, 'md5', 0)
+    with py.test.raises(Exception):
+        oz.ozutil.hash_file(src, 'md5', -1)
+
+def test_verify_sum(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'w').write('abc')
+
+    assert(oz.ozutil.verify_sum(src, 'BA7816BF8F01CFEA414140DE5DAE2223B00361A396177A9CB410FF61F20015AD', 'sha256'))
+    assert(not oz.ozutil.verify_sum(src, '900150983cd24fb0d6963f7d28e17f72', 'sha256'))
+
+def test_subprocess_check_output_stderr_tail(monkeypatch):
+    # record how much of stderr is being held on to as it arrives
+    held = []
+    stderr_tail = oz.ozutil._stderr_tail
+    def record_tail(stderr, data):
+        ret = stderr_tail(stderr, data)
+        held.append(len(ret))
+        return ret
+    monkeypatch.setattr(oz.ozutil, '_stderr_tail', record_tail)
+
+    for printfn in [None, lambda data: printed.append(len(data))]:
+        del held[:]
+        printed = []
+        kwargs = {}
+        if printfn is not None:
+            kwargs['printfn'] = printfn
+        stdout, stderr, retcode = oz.ozutil.subprocess_check_output(['sh', '-c', 'head -c 200000 /dev/zero; head -c 2000000 /dev/zero >&2; echo end >&2'],
+                                                                    **kwargs)
+        assert(len(stdout) == 200000)
+        assert(len(stderr) == 64*1024)
+        assert(stderr.endswith('end\n'))
+        # stderr is trimmed while the command runs, not just at the end
+        assert(len(held) > 1)
+        assert(max(held) <= 64*1024)
+        if printfn is not None:
+            assert(sum(printed) == 200000 + 2000000 + 4)
+
+def test_sha256sum_binary_and_bsd_mixed(tmpdir):
+    src = os.path.join(str(tmpdir), 'sha256sum')
+    f = open(src, 'w')
+    f.write('SHA256 (Fedora-11-i386-netinst.iso) = 1f8e7b4a8d1e9e4b6e0c5ad1c81f2b8a2e0e1f3c5d7b9a1c3e5f7a9b1d3f5a7c\n')
+    f.write('6e812e782e52b536c0307bb26b3c244e1c42b644235f5a4b242786b1ef375358 *Fedora-11-i386-DVD.iso\n')
+    f.close()
+
+    assert(oz.ozutil.get_sha256sum_from_file(src, 'Fedora-11-i386-DVD.iso') == '6e812e782e52b536c0307bb26b3c244e1c42b644235f5a4b242786b1ef375358')
+    assert(oz.ozutil.get_sha256sum_from_file(src, 'Fedora-11-i386-netinst.iso') == '1f8e7b4a8d1e9e4b6e0c5ad1c81f2b8a2e0e1f3c5d7b9a1c3e5f7a9b1d3f5a7c')
+    # a file whose name is a substring of a listed file is not a match
+    assert(oz.ozutil.get_sha256sum_from_file(src, 'DVD.iso') is None)